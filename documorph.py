@@ -1,40 +1,109 @@
 
 import streamlit as st
 from docx import Document
-from docx.shared import Pt, Inches
+from docx.document import Document as DocxDocument
+from docx.shared import Inches
 from docx.enum.text import WD_ALIGN_PARAGRAPH
-import tempfile, os, json, io
+from docx.oxml import OxmlElement
+from docx.oxml.ns import qn, nsmap
+from lxml import etree
+from docx.text.paragraph import Paragraph
+from copy import deepcopy
+import os, io, hashlib, sqlite3
+import orjson
+from functools import lru_cache
+
+# -----------------------------------------------------------------------
+#  Length helpers (widget values come from a small discrete set)
+# -----------------------------------------------------------------------
+@lru_cache(maxsize=64)
+def _sz_val(n):  return str(int(round(n * 2)))     # w:sz is in half-points
+
+@lru_cache(maxsize=64)
+def _inches(x):  return Inches(x)
+
+# -----------------------------------------------------------------------
+#  Input cleaning
+# -----------------------------------------------------------------------
+def clean_bullets(text: str) -> list[str]:
+    """One stripped item per non-blank line (any str.splitlines() separator)."""
+    return [s for s in map(str.strip, text.splitlines()) if s]
 
 # -----------------------------------------------------------------------
 #  DocuMorph Engine
 # -----------------------------------------------------------------------
+# widget option -> paragraph alignment (keys match the radio/selectbox options)
+_ALIGN_MAP    = {"Left": WD_ALIGN_PARAGRAPH.LEFT,
+                 "Center": WD_ALIGN_PARAGRAPH.CENTER,
+                 "Right": WD_ALIGN_PARAGRAPH.RIGHT,
+                 "Justify": WD_ALIGN_PARAGRAPH.JUSTIFY}
+_HF_ALIGN_MAP = {"Left": WD_ALIGN_PARAGRAPH.LEFT,
+                 "Center": WD_ALIGN_PARAGRAPH.CENTER,
+                 "Right": WD_ALIGN_PARAGRAPH.RIGHT}
+
+# direct <w:r> children of a paragraph (what Paragraph.runs wraps)
+_RUN_XPATH = etree.XPath("./w:r", namespaces={"w": nsmap["w"]})
+
 class DocuMorphEngine:
-    def __init__(self, docx_file: str | io.BytesIO | None = None):
-        self.document = Document(docx_file) if docx_file else Document()
+    def __init__(self, docx_file: str | io.BytesIO | DocxDocument | None = None):
+        if isinstance(docx_file, DocxDocument):
+            self.document = docx_file           # already parsed (e.g. a cached copy)
+        else:
+            self.document = Document(docx_file) if docx_file else Document()
+        # body paragraphs, walked once; content helpers append to keep it in sync
+        self._paragraphs = list(self.document.paragraphs)
+        self._caption_style = None        # resolved on first caption
 
     # ---------- global formatting -------------------------------------------------
+    @staticmethod
+    def _set_run_fonts(p, font_name, sz_val):
+        """Set font name/size on every run of <w:p> p, bypassing the Run/Font wrappers."""
+        for r in _RUN_XPATH(p):
+            rPr = r.get_or_add_rPr()
+            rFonts = rPr.get_or_add_rFonts()
+            rFonts.set(qn("w:ascii"), font_name)
+            rFonts.set(qn("w:hAnsi"), font_name)
+            rPr.get_or_add_sz().set(qn("w:val"), sz_val)
+
     def set_font(self, font_name, font_size):
-        for para in self.document.paragraphs:
-            for run in para.runs:
-                run.font.name = font_name
-                run.font.size = Pt(font_size)
+        sz_val = _sz_val(font_size)
+        for para in self._paragraphs:
+            self._set_run_fonts(para._p, font_name, sz_val)
 
     def set_line_spacing(self, spacing):
-        for para in self.document.paragraphs:
+        for para in self._paragraphs:
             para.paragraph_format.line_spacing = spacing
 
     def set_alignment(self, alignment):
-        align_map = {"Left": WD_ALIGN_PARAGRAPH.LEFT,
-                     "Center": WD_ALIGN_PARAGRAPH.CENTER,
-                     "Right": WD_ALIGN_PARAGRAPH.RIGHT,
-                     "Justify": WD_ALIGN_PARAGRAPH.JUSTIFY}
-        for para in self.document.paragraphs:
-            para.alignment = align_map.get(alignment, WD_ALIGN_PARAGRAPH.LEFT)
+        align_val = _ALIGN_MAP[alignment]
+        for para in self._paragraphs:
+            para.alignment = align_val
+
+    def apply_global_formatting(self, font_name, font_size, spacing, alignment):
+        """
+        Apply font, line spacing and alignment in a single pass over the body.
+        Equivalent to calling set_font / set_line_spacing / set_alignment in turn,
+        but walks document.paragraphs once instead of three times.
+        Spacing/alignment writes are skipped only when every paragraph already
+        carries the target value directly (all() stops at the first mismatch).
+        """
+        paras     = self._paragraphs
+        sz_val    = _sz_val(font_size)
+        align_val = _ALIGN_MAP[alignment]
+        do_spacing = not all(p.paragraph_format.line_spacing == spacing for p in paras)
+        do_align   = not all(p.alignment == align_val for p in paras)
+
+        for para in paras:
+            if do_spacing:
+                para.paragraph_format.line_spacing = spacing
+            if do_align:
+                para.alignment = align_val
+            self._set_run_fonts(para._p, font_name, sz_val)
 
     def set_margins(self, top, bottom, left, right):
         sec = self.document.sections[0]
-        sec.top_margin, sec.bottom_margin = Inches(top), Inches(bottom)
-        sec.left_margin, sec.right_margin = Inches(left), Inches(right)
+        sec.top_margin, sec.bottom_margin = _inches(top), _inches(bottom)
+        sec.left_margin, sec.right_margin = _inches(left), _inches(right)
 
     # ---------- logo --------------------------------------------------------------
     def add_logo(self, image_file: io.BytesIO | str, width, height):
@@ -45,21 +114,27 @@ class DocuMorphEngine:
         hdr = self.document.sections[0].header
         hdr.is_linked_to_previous = False
 
-        # Ensure we have a paragraph to insert before
-        first_para = hdr.paragraphs[0] if hdr.paragraphs else hdr.add_paragraph()
-        logo_para = first_para.insert_paragraph_before()
-        run = logo_para.add_run()
+        # Keep a text paragraph after the logo for set_header_footer to fill
+        hdr_el = hdr._element
+        if hdr_el.find(qn("w:p")) is None:
+            hdr.add_paragraph()
+        logo_p = OxmlElement("w:p")
+        hdr_el.insert(0, logo_p)
+        run = Paragraph(logo_p, hdr).add_run()
 
         # rewind BytesIO if needed
         if isinstance(image_file, (io.BytesIO, io.BufferedReader)):
             image_file.seek(0)
-        run.add_picture(image_file, width=Inches(width), height=Inches(height))
+        run.add_picture(image_file, width=_inches(width), height=_inches(height))
 
     # ---------- header / footer ---------------------------------------------------
     def set_header_footer(self, h_text, f_text, size, align):
-        align_map = {"Left": WD_ALIGN_PARAGRAPH.LEFT,
-                     "Center": WD_ALIGN_PARAGRAPH.CENTER,
-                     "Right": WD_ALIGN_PARAGRAPH.RIGHT}
+        sz_val    = _sz_val(size)
+        align_val = _HF_ALIGN_MAP[align]
+
+        # Linked sections share a part; keying on the <w:p> writes each distinct
+        # header/footer paragraph once.
+        jobs = {}
         for sec in self.document.sections:
             hdr, ftr = sec.header, sec.footer
             if not hdr.paragraphs:
@@ -69,38 +144,138 @@ class DocuMorphEngine:
 
             h_para = hdr.paragraphs[-1]   # after logo, if present
             f_para = ftr.paragraphs[0]
+            jobs.setdefault(h_para._p, (h_para, h_text))
+            jobs.setdefault(f_para._p, (f_para, f_text))
 
-            h_para.text, f_para.text = h_text, f_text
-            for p in (h_para, f_para):
-                if p.runs:
-                    p.runs[0].font.size = Pt(size)
-                p.alignment = align_map.get(align, WD_ALIGN_PARAGRAPH.LEFT)
+        for p, text in jobs.values():
+            self._apply_hf_one(p, text, sz_val, align_val)
+
+    @staticmethod
+    def _apply_hf_one(p, text, sz_val, align_val):
+        p.text = text
+        r = p._p.find(qn("w:r"))
+        if r is not None:
+            # write w:sz (half-points) directly instead of via Font.size
+            r.get_or_add_rPr().get_or_add_sz().set(qn("w:val"), sz_val)
+        p.alignment = align_val
 
     # ---------- content helpers ---------------------------------------------------
-    def add_section_title(self, title):        self.document.add_heading(title, level=1)
-    def add_bullet_list(self, items):          [self.document.add_paragraph(i, style="List Bullet") for i in items]
+    def add_section_title(self, title):        self._paragraphs.append(self.document.add_heading(title, level=1))
+
+    def add_bullet_list(self, items):
+        """
+        Append one "List Bullet" paragraph per item.
+        Only the first goes through add_paragraph (style resolved once); the rest
+        are clones of its run-less <w:p>, chained in place with addnext. Text goes
+        through add_run so tabs/newlines still become <w:tab/>/<w:br/>.
+        """
+        items = list(items)
+        if not items:
+            return
+        first = self.document.add_paragraph(style="List Bullet")
+        template, parent = deepcopy(first._p), first._parent   # pPr only
+
+        prev, para = first._p, first
+        for i, item in enumerate(items):
+            if i:
+                new_p = deepcopy(template)
+                prev.addnext(new_p)
+                prev, para = new_p, Paragraph(new_p, parent)
+            if item:
+                para.add_run(item)
+            self._paragraphs.append(para)
 
     def add_figure(self, image, w, h, caption="", pos="Below"):
-        if pos == "Above" and caption:
-            self.document.add_paragraph(caption, style="Caption")
+        # no caption, or an unknown position, places the picture alone, as before
+        fn = self._FIG_DISPATCH.get((pos, bool(caption)))
+        if fn is None:
+            self._add_figure_none(image, w, h)
+        else:
+            fn(self, image, w, h, caption)
+
+    def _add_figure_none(self, image, w, h):
         p = self.document.add_paragraph()
-        p.add_run().add_picture(image, width=Inches(w), height=Inches(h))
-        if pos == "Below" and caption:
-            self.document.add_paragraph(caption, style="Caption")
+        p.add_run().add_picture(image, width=_inches(w), height=_inches(h))
+        self._paragraphs.append(p)
+
+    def _add_figure_above(self, image, w, h, caption):
+        self._add_caption(caption)
+        self._add_figure_none(image, w, h)
+
+    def _add_figure_below(self, image, w, h, caption):
+        self._add_figure_none(image, w, h)
+        self._add_caption(caption)
+
+    # plain functions, not bound methods: a per-instance table of bound methods
+    # would tie each engine (and its Document) into a reference cycle
+    _FIG_DISPATCH = {("Above", True): _add_figure_above,
+                     ("Below", True): _add_figure_below}
+
+    def _add_caption(self, caption):
+        # looked up lazily: a base DOCX without a "Caption" style should still
+        # load, and only fail if a caption is actually requested
+        if self._caption_style is None:
+            self._caption_style = self.document.styles["Caption"]
+        self._paragraphs.append(self.document.add_paragraph(caption, style=self._caption_style))
 
     # ---------- save --------------------------------------------------------------
-    def save(self, path): self.document.save(path)
+    def save(self, path_or_stream): self.document.save(path_or_stream)
 
 # -----------------------------------------------------------------------
 #  Template manager helpers
 # -----------------------------------------------------------------------
 TEMPLATE_DIR = "templates"
+TEMPLATE_DB  = os.path.join(TEMPLATE_DIR, "templates.db")
 os.makedirs(TEMPLATE_DIR, exist_ok=True)
 
-def list_templates():  return [f[:-5] for f in os.listdir(TEMPLATE_DIR) if f.endswith(".json")]
-def load_template(name):  return json.load(open(os.path.join(TEMPLATE_DIR, f"{name}.json"))) if name else {}
-def save_template(name, cfg):  json.dump(cfg, open(os.path.join(TEMPLATE_DIR, f"{name}.json"), "w"))
-def delete_template(name):  os.remove(os.path.join(TEMPLATE_DIR, f"{name}.json"))
+# One connection for the server process (Streamlit re-executes this module on
+# every rerun, so a plain module-level connect would reopen it each time).
+@st.cache_resource
+def _template_db():
+    db = sqlite3.connect(TEMPLATE_DB, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    with db:
+        db.execute("CREATE TABLE IF NOT EXISTS templates (name TEXT PRIMARY KEY, cfg BLOB NOT NULL)")
+    # one-time import of templates saved by earlier versions as one JSON file
+    # each; the file is renamed once its row is committed so it can't come back
+    for f in os.listdir(TEMPLATE_DIR):
+        if f.endswith(".json"):
+            path = os.path.join(TEMPLATE_DIR, f)
+            with open(path, "rb") as fh, db:
+                db.execute("INSERT OR IGNORE INTO templates VALUES (?, ?)", (f[:-5], fh.read()))
+            os.replace(path, path + ".migrated")
+    return db
+
+@st.cache_data
+def list_templates():
+    return [n for (n,) in _template_db().execute("SELECT name FROM templates ORDER BY name")]
+
+@st.cache_data
+def load_template(name):
+    row = _template_db().execute("SELECT cfg FROM templates WHERE name = ?", (name,)).fetchone()
+    return orjson.loads(row[0]) if row else {}
+
+def save_template(name, cfg):
+    with _template_db() as db:
+        db.execute("INSERT OR REPLACE INTO templates VALUES (?, ?)", (name, orjson.dumps(dict(cfg))))
+    list_templates.clear(); load_template.clear()
+
+def delete_template(name):
+    with _template_db() as db:
+        db.execute("DELETE FROM templates WHERE name = ?", (name,))
+    legacy = os.path.join(TEMPLATE_DIR, f"{name}.json")
+    if os.path.exists(legacy):
+        os.remove(legacy)
+    list_templates.clear(); load_template.clear()
+
+# -----------------------------------------------------------------------
+#  Base document cache
+# -----------------------------------------------------------------------
+# Keyed on the upload's digest; the leading underscore keeps Streamlit from
+# hashing the raw bytes. Callers must deepcopy the result before mutating it.
+# Bounded: each entry is a fully parsed document shared by all sessions.
+@st.cache_resource(max_entries=4)
+def _parse_docx(digest, _data):  return Document(io.BytesIO(_data))
 
 # -----------------------------------------------------------------------
 #  Streamlit UI
@@ -119,7 +294,7 @@ st.markdown("""
 with st.sidebar:
     st.header("💾 Template Manager")
     sel = st.selectbox("Load template", ["<none>"] + list_templates())
-    cfg = load_template(sel if sel != "<none>" else "")
+    cfg = load_template(sel) if sel != "<none>" else {}
 
     new_name = st.text_input("Save current as")
     if st.button("💾 Save Template"):
@@ -183,24 +358,26 @@ with tabs[3]:
         if not uploaded_file:
             st.error("Please upload a DOCX first!")
         else:
-            eng = DocuMorphEngine(uploaded_file)
-            eng.set_font(font_name, font_size)
-            eng.set_line_spacing(line_spacing)
-            eng.set_alignment(alignment)
+            # read each upload once; engine calls get their own fresh stream
+            data       = uploaded_file.getvalue()
+            logo_bytes = logo.getvalue() if logo else None
+            fig_bytes  = figure.getvalue() if figure else None
+
+            base = _parse_docx(hashlib.blake2b(data, digest_size=16).digest(), data)
+            eng  = DocuMorphEngine(deepcopy(base))
+            eng.apply_global_formatting(font_name, font_size, line_spacing, alignment)
             eng.set_margins(*st.session_state["margins"])
 
-            if logo:  eng.add_logo(logo, logo_w, logo_h)
+            if logo_bytes:  eng.add_logo(io.BytesIO(logo_bytes), logo_w, logo_h)
             eng.set_header_footer(header_text, footer_text, hf_size, hf_align)
 
             if section_title.strip(): eng.add_section_title(section_title.strip())
-            bullets = [b.strip() for b in bullets_input.splitlines() if b.strip()]
+            bullets = clean_bullets(bullets_input)
             if bullets: eng.add_bullet_list(bullets)
-            if figure:  figure.seek(0); eng.add_figure(figure, fig_w, fig_h, caption, caption_pos)
-
-            tmp = tempfile.NamedTemporaryFile(delete=False, suffix=".docx")
-            eng.save(tmp.name); tmp.close()
-            with open(tmp.name, "rb") as f:
-                st.download_button("⬇ Download Document", f, "formatted.docx",
-                                   "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
-                                   use_container_width=True, key="download", help="Download the formatted DOCX")
-            os.unlink(tmp.name)
+            if fig_bytes:   eng.add_figure(io.BytesIO(fig_bytes), fig_w, fig_h, caption, caption_pos)
+
+            buf = io.BytesIO()
+            eng.save(buf); buf.seek(0)
+            st.download_button("⬇ Download Document", buf.getvalue(), "formatted.docx",
+                               "application/vnd.openxmlformats-officedocument.wordprocessingml.document",
+                               use_container_width=True, key="download", help="Download the formatted DOCX")